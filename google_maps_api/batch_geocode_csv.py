@@ -1,54 +1,158 @@
+import numpy as np
 import pandas as pd
 import googlemaps
 import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 from tqdm import tqdm  # for progress bar
 
+# On-disk cache so reruns (and repeated addresses) don't re-hit the paid API
+GEOCODE_CACHE_DB = "geocode_cache.db"
+
+# Concurrent geocoding requests; keep the combined rate under the API quota
+MAX_WORKERS = 10
+REQUESTS_PER_SECOND = 40
+
+# Rows processed (and written out) per chunk, so memory stays bounded
+# regardless of input size
+CHUNK_SIZE = 10_000
+
+def normalize_address(address):
+    """Normalize an address so trivially different spellings share a cache entry."""
+    return re.sub(r'\s+', ' ', str(address).strip()).lower()
+
+def open_geocode_cache(db_path=GEOCODE_CACHE_DB):
+    """Open (and create if needed) the SQLite geocode cache."""
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS geocode_cache ("
+        "address TEXT PRIMARY KEY, lat REAL, lng REAL)"
+    )
+    return conn
+
 def geocode_addresses(input_csv, output_csv):
     # Load environment variables
     load_dotenv()
-    
+
     # Initialize Google Maps client
     gmaps = googlemaps.Client(key=os.getenv('GOOGLE_MAPS_API_KEY'))
-    
-    # Read the CSV file
-    df = pd.read_csv(input_csv)
-    
-    # Create new columns for latitude and longitude
-    df['latitude'] = None
-    df['longitude'] = None
-    
-    # Process each address with progress bar
-    for idx in tqdm(range(len(df)), desc="Geocoding addresses"):
-        address = df.loc[idx, 'address']
-        
-        # Skip if address is empty
-        if pd.isna(address) or str(address).strip() == '':
-            continue
-            
-        try:
-            # Attempt to geocode the address
-            geocode_result = gmaps.geocode(address)
-            
-            # If we got results, extract the coordinates
-            if geocode_result and len(geocode_result) > 0:
-                location = geocode_result[0]['geometry']['location']
-                df.loc[idx, 'latitude'] = location['lat']
-                df.loc[idx, 'longitude'] = location['lng']
-                
-        except Exception as e:
-            print(f"Error geocoding address '{address}': {str(e)}")
-            continue
-    
-    # Save the results
-    df.to_csv(output_csv, index=False)
+
+    # Open the persistent cache plus an in-memory memo for this run
+    cache = open_geocode_cache()
+    memo = {}
+    cache_lock = threading.Lock()
+
+    # Simple token spacing so the thread pool stays under the API QPS limit
+    rate_lock = threading.Lock()
+    last_request = [0.0]
+
+    def throttle():
+        with rate_lock:
+            wait = last_request[0] + 1.0 / REQUESTS_PER_SECOND - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            last_request[0] = time.monotonic()
+
+    def cached_geocode(address):
+        """Return (lat, lng) for an address, consulting the caches before the API."""
+        key = normalize_address(address)
+
+        if key in memo:
+            return memo[key]
+
+        with cache_lock:
+            row = cache.execute(
+                "SELECT lat, lng FROM geocode_cache WHERE address = ?", (key,)
+            ).fetchone()
+        if row is not None:
+            memo[key] = row
+            return row
+
+        coords = None
+        throttle()
+        geocode_result = gmaps.geocode(address)
+
+        # If we got results, extract the coordinates and persist them
+        if geocode_result and len(geocode_result) > 0:
+            location = geocode_result[0]['geometry']['location']
+            coords = (location['lat'], location['lng'])
+            with cache_lock:
+                cache.execute(
+                    "INSERT OR REPLACE INTO geocode_cache (address, lat, lng) VALUES (?, ?, ?)",
+                    (key, coords[0], coords[1])
+                )
+                cache.commit()
+
+        memo[key] = coords
+        return coords
+
+    # Geocoded results shared across chunks (keyed by normalized address)
+    results = {}
+    total_addresses = 0
+    successful_geocodes = 0
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # Stream the CSV in chunks instead of loading the whole file at once
+        for chunk_index, df in enumerate(pd.read_csv(input_csv, chunksize=CHUNK_SIZE)):
+            # Vectorized pre-filter: drop NaN/blank addresses in one pandas
+            # pass, then dedupe to one entry per normalized address
+            valid = df['address'].fillna('').astype(str).str.strip()
+            unique_addresses = {}
+            for address in valid[valid != ''].unique():
+                key = normalize_address(address)
+                if key not in unique_addresses and key not in results:
+                    unique_addresses[key] = address
+
+            # Geocode unique addresses concurrently; network latency dominates here
+            futures = {
+                executor.submit(cached_geocode, address): key
+                for key, address in unique_addresses.items()
+            }
+            for future in tqdm(as_completed(futures), total=len(futures),
+                               desc=f"Geocoding chunk {chunk_index + 1}"):
+                key = futures[future]
+                try:
+                    results[key] = future.result()
+                except Exception as e:
+                    print(f"Error geocoding address '{unique_addresses[key]}': {str(e)}")
+                    results[key] = None
+
+            # Fill preallocated float arrays and assign each column once;
+            # no per-row pandas indexing and no object-dtype intermediates
+            lats = np.full(len(df), np.nan, dtype='float64')
+            lngs = np.full(len(df), np.nan, dtype='float64')
+            for position, address in enumerate(df['address']):
+                if pd.isna(address):
+                    continue
+                coords = results.get(normalize_address(address))
+                if coords is not None:
+                    lats[position], lngs[position] = coords
+            df['latitude'] = lats
+            df['longitude'] = lngs
+
+            # Shrink integer columns before writing
+            for column in df.select_dtypes(include='integer').columns:
+                df[column] = pd.to_numeric(df[column], downcast='integer')
+
+            # Append each processed chunk to the output file as we go
+            df.to_csv(output_csv, index=False, mode='w' if chunk_index == 0 else 'a',
+                      header=chunk_index == 0)
+
+            total_addresses += len(df)
+            successful_geocodes += df['latitude'].notna().sum()
+
+    cache.close()
     print(f"\nGeocoding complete. Results saved to {output_csv}")
-    
+
     # Print summary statistics
-    total_addresses = len(df)
-    successful_geocodes = df['latitude'].notna().sum()
     failed_geocodes = total_addresses - successful_geocodes
-    
+
     print(f"\nSummary:")
     print(f"Total addresses processed: {total_addresses}")
     print(f"Successful geocoding: {successful_geocodes}")
@@ -59,5 +163,5 @@ if __name__ == "__main__":
     # Usage example
     input_file = "addresses.csv"  # Your input CSV file
     output_file = "addresses_with_coords.csv"  # Where to save the results
-    
-    geocode_addresses(input_file, output_file)
\ No newline at end of file
+
+    geocode_addresses(input_file, output_file)
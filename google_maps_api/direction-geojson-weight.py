@@ -5,49 +5,40 @@ from datetime import datetime
 import json
 import pytz
 import pandas as pd
-from collections import defaultdict
+
+try:
+    import orjson  # much faster JSON encoding for large feature collections
+except ImportError:
+    orjson = None
+from collections import defaultdict, deque
+
+from gmaps_cache import cached_directions
+from polyline_utils import decode_polyline
 
 # Configuration
 load_dotenv()
 PROJECT_TITLE = "weighted_routes"
 
-def decode_polyline(polyline_str):
-    # Keeping the original decode_polyline function unchanged
-    index, lat, lng = 0, 0, 0
-    coordinates = []
-    changes = {'latitude': 0, 'longitude': 0}
-
-    while index < len(polyline_str):
-        for unit in ['latitude', 'longitude']: 
-            shift, result = 0, 0
-
-            while True:
-                byte = ord(polyline_str[index]) - 63
-                index += 1
-                result |= (byte & 0x1f) << shift
-                shift += 5
-                if not byte >= 0x20:
-                    break
+def dumps_geojson(obj):
+    """Encode one GeoJSON fragment to compact utf-8 bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=float)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
 
-            if (result & 1):
-                changes[unit] = ~(result >> 1)
-            else:
-                changes[unit] = (result >> 1)
-
-        lat += changes['latitude']
-        lng += changes['longitude']
-
-        coordinates.append([lng / 100000.0, lat / 100000.0])
-
-    return coordinates
+def pack_coord(coord):
+    """Pack a [lng, lat] pair into a single int (1e7 fixed-point, bit-shifted)."""
+    return (int(round(coord[0] * 1e7)) << 32) | (int(round(coord[1] * 1e7)) & 0xFFFFFFFF)
 
 def segment_key(coord1, coord2):
     """Create a unique key for a segment based on its coordinates"""
-    return tuple(sorted([tuple(coord1), tuple(coord2)]))
+    key1 = pack_coord(coord1)
+    key2 = pack_coord(coord2)
+    return (key1, key2) if key1 < key2 else (key2, key1)
 
 def create_weighted_routes_geojson(csv_file, mode="driving", timezone="Asia/Taipei"):
-    # Read routes from CSV
+    # Read routes from CSV; convert weights once instead of per row
     routes_df = pd.read_csv(csv_file)
+    routes_df['weight'] = routes_df['weight'].astype(float)
     
     # Initialize Google Maps client
     gmaps = googlemaps.Client(key=os.getenv('GOOGLE_MAPS_API_KEY'))
@@ -61,28 +52,30 @@ def create_weighted_routes_geojson(csv_file, mode="driving", timezone="Asia/Taip
     # Dictionary to store segment metadata
     segment_metadata = {}
     
-    # Process each route
-    for _, row in routes_df.iterrows():
+    # Process each route (itertuples avoids building a Series per row)
+    for row in routes_df.itertuples(index=False):
         try:
-            directions_result = gmaps.directions(
-                row['start'],
-                row['destination'],
+            directions_result = cached_directions(
+                gmaps,
+                row.start,
+                row.destination,
                 mode=mode,
                 departure_time=current_time,
             )
-            
+
             if not directions_result:
-                print(f"No route found for {row['start']} to {row['destination']}. Skipping...")
+                print(f"No route found for {row.start} to {row.destination}. Skipping...")
                 continue
             
-            # Decode the polyline to get coordinates
-            coords = decode_polyline(directions_result[0]['overview_polyline']['points'])
+            # Decode the polyline to get coordinates in GeoJSON (lng, lat) order
+            coords = decode_polyline(directions_result[0]['overview_polyline']['points'],
+                                     swap_xy=True)
             
             # Process segments
             for i in range(len(coords) - 1):
                 seg_key = segment_key(coords[i], coords[i+1])
                 # Add weight to segment
-                segment_weights[seg_key] += float(row['weight'])
+                segment_weights[seg_key] += row.weight
                 
                 # Store segment metadata if not already stored
                 if seg_key not in segment_metadata:
@@ -92,52 +85,71 @@ def create_weighted_routes_geojson(csv_file, mode="driving", timezone="Asia/Taip
                         'end_point': coords[i+1]
                     }
             
-            print(f"Successfully processed route: {row['start']} to {row['destination']}")
+            print(f"Successfully processed route: {row.start} to {row.destination}")
             
         except Exception as e:
-            print(f"Error processing route from {row['start']} to {row['destination']}: {str(e)}")
+            print(f"Error processing route from {row.start} to {row.destination}: {str(e)}")
             continue
     
+    # Index segments by their endpoints so adjacency lookups are O(1)
+    # instead of rescanning every segment per extension
+    head_index = defaultdict(list)
+    tail_index = defaultdict(list)
+    for seg_key, metadata in segment_metadata.items():
+        head_index[tuple(metadata['start_point'])].append(seg_key)
+        tail_index[tuple(metadata['end_point'])].append(seg_key)
+
+    # Stream combined features straight to the output file so peak memory
+    # stays at one feature rather than the whole collection
+    filename = f"{PROJECT_TITLE}_{current_time.strftime('%Y%m%d_%H%M%S')}.geojson"
+    output = open(filename, 'wb')
+    output.write(b'{"type":"FeatureCollection","features":[')
+
     # Combine adjacent segments with same weight
-    combined_segments = []
+    feature_count = 0
     processed_segments = set()
-    
+
+    def next_unprocessed(candidates, rounded_weight):
+        for candidate in candidates:
+            if (candidate not in processed_segments
+                    and round(segment_weights[candidate], 3) == rounded_weight):
+                return candidate
+        return None
+
     for seg_key, weight in segment_weights.items():
         if seg_key in processed_segments:
             continue
-            
-        current_segment = list(segment_metadata[seg_key]['coordinates'])
+
+        current_segment = deque(segment_metadata[seg_key]['coordinates'])
         current_weight = weight
+        # Round weights so "same weight" is an exact dict/compare, not a tolerance scan
+        rounded_weight = round(weight, 3)
         processed_segments.add(seg_key)
-        
-        # Try to extend segment
+
+        # Walk forward from the tail
         while True:
-            # Look for adjacent segment with same weight
-            extended = False
-            for other_seg_key, other_weight in segment_weights.items():
-                if other_seg_key in processed_segments:
-                    continue
-                    
-                if abs(other_weight - current_weight) < 0.001:  # Compare with small tolerance
-                    other_coords = segment_metadata[other_seg_key]['coordinates']
-                    
-                    # Check if segments are adjacent
-                    if tuple(current_segment[-1]) == tuple(other_coords[0]):
-                        current_segment.append(other_coords[1])
-                        processed_segments.add(other_seg_key)
-                        extended = True
-                        break
-                    elif tuple(current_segment[0]) == tuple(other_coords[1]):
-                        current_segment.insert(0, other_coords[0])
-                        processed_segments.add(other_seg_key)
-                        extended = True
-                        break
-            
-            if not extended:
+            next_key = next_unprocessed(head_index.get(tuple(current_segment[-1]), ()),
+                                        rounded_weight)
+            if next_key is None:
                 break
-        
-        # Add combined segment to results
-        combined_segments.append({
+            current_segment.append(segment_metadata[next_key]['coordinates'][1])
+            processed_segments.add(next_key)
+
+        # Walk backward from the head
+        while True:
+            prev_key = next_unprocessed(tail_index.get(tuple(current_segment[0]), ()),
+                                        rounded_weight)
+            if prev_key is None:
+                break
+            current_segment.appendleft(segment_metadata[prev_key]['coordinates'][0])
+            processed_segments.add(prev_key)
+
+        current_segment = list(current_segment)
+
+        # Write the combined segment straight to the output
+        if feature_count:
+            output.write(b',')
+        output.write(dumps_geojson({
             "type": "Feature",
             "geometry": {
                 "type": "LineString",
@@ -147,25 +159,20 @@ def create_weighted_routes_geojson(csv_file, mode="driving", timezone="Asia/Taip
                 "weight": current_weight,
                 "segment_count": len(current_segment) - 1
             }
-        })
-    
-    # Create final GeoJSON
-    geojson_data = {
-        "type": "FeatureCollection",
-        "features": combined_segments,
-        "properties": {
-            "project": PROJECT_TITLE,
-            "created_at": current_time.isoformat(),
-            "total_segments": len(combined_segments)
-        }
-    }
-    
-    # Save to file
-    filename = f"{PROJECT_TITLE}_{current_time.strftime('%Y%m%d_%H%M%S')}.geojson"
-    with open(filename, 'w', encoding='utf-8') as f:
-        json.dump(geojson_data, f, ensure_ascii=False, indent=2)
-    
-    print(f"\nSuccessfully saved {len(combined_segments)} weighted segments to: {filename}")
+        }))
+        feature_count += 1
+
+    # Close the collection with its summary properties
+    output.write(b'],"properties":')
+    output.write(dumps_geojson({
+        "project": PROJECT_TITLE,
+        "created_at": current_time.isoformat(),
+        "total_segments": feature_count
+    }))
+    output.write(b'}')
+    output.close()
+
+    print(f"\nSuccessfully saved {feature_count} weighted segments to: {filename}")
     return filename
 
 if __name__ == "__main__":
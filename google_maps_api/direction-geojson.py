@@ -5,6 +5,14 @@ from datetime import datetime
 import json
 import pytz
 
+try:
+    import orjson  # much faster JSON encoding for large feature collections
+except ImportError:
+    orjson = None
+
+from gmaps_cache import cached_directions
+from polyline_utils import decode_polyline
+
 # Configuration
 load_dotenv()
 PROJECT_TITLE = "commute_routes"
@@ -17,47 +25,29 @@ LOCATIONS = [
 
 gmaps = googlemaps.Client(key=os.getenv('GOOGLE_MAPS_API_KEY'))
 
-def decode_polyline(polyline_str):
-    index, lat, lng = 0, 0, 0
-    coordinates = []
-    changes = {'latitude': 0, 'longitude': 0}
-
-    while index < len(polyline_str):
-        for unit in ['latitude', 'longitude']: 
-            shift, result = 0, 0
-
-            while True:
-                byte = ord(polyline_str[index]) - 63
-                index += 1
-                result |= (byte & 0x1f) << shift
-                shift += 5
-                if not byte >= 0x20:
-                    break
-
-            if (result & 1):
-                changes[unit] = ~(result >> 1)
-            else:
-                changes[unit] = (result >> 1)
-
-        lat += changes['latitude']
-        lng += changes['longitude']
-
-        coordinates.append([lng / 100000.0, lat / 100000.0])
-
-    return coordinates
+def dumps_geojson(obj):
+    """Encode one GeoJSON fragment to compact utf-8 bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=float)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
 
 def create_routes_geojson(location_pairs, mode="driving", timezone="Asia/Taipei"):
     # Get current time in specified timezone
     tz = pytz.timezone(timezone)
     current_time = datetime.now(tz)
-    
-    # Initialize features list for successful routes
-    features = []
-    
+
+    # Stream features to the file as routes complete, so peak memory stays
+    # at one feature rather than the whole collection
+    filename = f"{PROJECT_TITLE}_{current_time.strftime('%Y%m%d_%H%M%S')}.geojson"
+    feature_count = 0
+    output = open(filename, 'wb')
+    output.write(b'{"type":"FeatureCollection","features":[')
+
     for start_location, end_location in location_pairs:
         try:
-            # Get directions
-            directions_result = gmaps.directions(
+            # Get directions (cached on disk per origin/destination/hour)
+            directions_result = cached_directions(
+                gmaps,
                 start_location,
                 end_location,
                 mode=mode,
@@ -73,7 +63,10 @@ def create_routes_geojson(location_pairs, mode="driving", timezone="Asia/Taipei"
                 "type": "Feature",
                 "geometry": {
                     "type": "LineString",
-                    "coordinates": decode_polyline(directions_result[0]['overview_polyline']['points'])
+                    "coordinates": decode_polyline(
+                        directions_result[0]['overview_polyline']['points'],
+                        swap_xy=True  # GeoJSON wants (lng, lat)
+                    )
                 },
                 "properties": {
                     "start_location": start_location,
@@ -87,34 +80,32 @@ def create_routes_geojson(location_pairs, mode="driving", timezone="Asia/Taipei"
                 }
             }
             
-            features.append(route_feature)
+            if feature_count:
+                output.write(b',')
+            output.write(dumps_geojson(route_feature))
+            feature_count += 1
             print(f"Successfully processed route: {start_location} to {end_location}")
-            
+
         except Exception as e:
             print(f"Error processing route from {start_location} to {end_location}: {str(e)}")
             continue
-    
-    # Only create and save GeoJSON if there are successful routes
-    if features:
-        # Create GeoJSON FeatureCollection
-        geojson_data = {
-            "type": "FeatureCollection",
-            "features": features,
-            "properties": {
-                "project": PROJECT_TITLE,
-                "created_at": current_time.isoformat(),
-                "total_routes": len(features)
-            }
-        }
-        
-        # Save to file
-        filename = f"{PROJECT_TITLE}_{current_time.strftime('%Y%m%d_%H%M%S')}.geojson"
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(geojson_data, f, ensure_ascii=False, indent=2)
-        
-        print(f"\nSuccessfully saved {len(features)} routes to: {filename}")
+
+    # Close the collection with its summary properties
+    output.write(b'],"properties":')
+    output.write(dumps_geojson({
+        "project": PROJECT_TITLE,
+        "created_at": current_time.isoformat(),
+        "total_routes": feature_count
+    }))
+    output.write(b'}')
+    output.close()
+
+    # Only keep the file if there are successful routes
+    if feature_count:
+        print(f"\nSuccessfully saved {feature_count} routes to: {filename}")
         return filename
     else:
+        os.remove(filename)
         print("\nNo successful routes to save.")
         return None
 
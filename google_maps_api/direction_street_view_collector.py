@@ -1,19 +1,24 @@
+import asyncio
 import os
 import pathlib
-import requests
-import time
 import csv
 from datetime import datetime
-from math import radians, sin, cos, sqrt, atan2
+import aiohttp
+import numpy as np
 import googlemaps
 from dotenv import load_dotenv
 from tqdm import tqdm
 
+from gmaps_cache import cached_directions
+from polyline_utils import decode_polyline
+
 # Load environment variables
 load_dotenv()
 
 # Global Configuration
 PROJECT_NAME = "my_street_view_project"
+PROJECT_DIR = pathlib.Path(PROJECT_NAME)
+IMAGES_DIR = PROJECT_DIR / "images"
 STREETVIEW_INTERVAL = 1000  # meters between each street view capture
 MAX_API_CALLS = 500  # Maximum number of API calls allowed
 STREETVIEW_ANGLES = [0, 90, 180, 270]  # List of angles to capture at each point
@@ -23,6 +28,8 @@ STREETVIEW_PARAMS = {
     "size_x": 640,
     "size_y": 640
 }
+CONCURRENT_REQUESTS = 20  # simultaneous Street View downloads
+CSV_BATCH_SIZE = 100  # metadata rows buffered between CSV writes
 
 # API Configuration
 GOOGLE_MAPS_API_KEY = os.getenv('GOOGLE_MAPS_API_KEY')
@@ -45,72 +52,47 @@ class APICallCounter:
     def close(self):
         self.pbar.close()
 
-def decode_polyline(polyline_str):
-    """Decodes a Google Maps encoded polyline string."""
-    index, lat, lng = 0, 0, 0
-    coordinates = []
-    changes = {'latitude': 0, 'longitude': 0}
-
-    while index < len(polyline_str):
-        for unit in ['latitude', 'longitude']:
-            shift, result = 0, 0
-            while True:
-                byte = ord(polyline_str[index]) - 63
-                index += 1
-                result |= (byte & 0x1f) << shift
-                shift += 5
-                if not byte >= 0x20:
-                    break
-            if (result & 1):
-                changes[unit] = ~(result >> 1)
-            else:
-                changes[unit] = (result >> 1)
-
-        lat += changes['latitude']
-        lng += changes['longitude']
-        coordinates.append((lat / 100000.0, lng / 100000.0))
-
-    return coordinates
-
-def haversine_distance(lat1, lon1, lat2, lon2):
-    """Calculate the distance between two points on Earth."""
+def segment_distances(coordinates):
+    """Haversine distance in meters for each adjacent pair, vectorized."""
     R = 6371000  # Earth's radius in meters
 
-    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
+    arr = np.radians(np.asarray(coordinates, dtype=np.float64))
+    lat, lon = arr[:, 0], arr[:, 1]
+    dlat = np.diff(lat)
+    dlon = np.diff(lon)
 
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * atan2(sqrt(a), sqrt(1-a))
-    return R * c
+    a = np.sin(dlat/2)**2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(dlon/2)**2
+    return 2 * R * np.arcsin(np.sqrt(a))
 
 def interpolate_points(coordinates, interval):
     """Interpolate points along the path at specified intervals."""
-    interpolated = [coordinates[0]]
-    accumulated_distance = 0
-    
-    for i in range(len(coordinates)-1):
-        start_lat, start_lng = coordinates[i]
-        end_lat, end_lng = coordinates[i+1]
-        
-        segment_distance = haversine_distance(start_lat, start_lng, end_lat, end_lng)
-        accumulated_distance += segment_distance
-        
-        while accumulated_distance >= interval:
-            # Calculate the fraction of the distance to interpolate
-            fraction = 1 - (accumulated_distance - interval) / segment_distance
-            
-            # Linear interpolation
-            new_lat = start_lat + (end_lat - start_lat) * fraction
-            new_lng = start_lng + (end_lng - start_lng) * fraction
-            
-            interpolated.append((new_lat, new_lng))
-            accumulated_distance -= interval
-    
-    return interpolated
+    coords = np.asarray(coordinates, dtype=np.float64)
+    segments = segment_distances(coordinates)
+
+    # Cumulative distance at each vertex, then the sample positions
+    cumulative = np.concatenate(([0.0], np.cumsum(segments)))
+    targets = np.arange(interval, cumulative[-1], interval)
+
+    # Locate each target's segment and interpolate linearly within it
+    idx = np.searchsorted(cumulative, targets)
+    fraction = (targets - cumulative[idx - 1]) / segments[idx - 1]
+    points = coords[idx - 1] + (coords[idx] - coords[idx - 1]) * fraction[:, None]
 
-def fetch_streetview(lat, lng, heading, api_counter, **params):
+    return [tuple(coordinates[0])] + [tuple(p) for p in points.tolist()]
+
+async def fetch_streetview(session, semaphore, lat, lng, heading, api_counter,
+                           existing_images=frozenset(), **params):
     """Fetch a Google Street View image with retry logic."""
+    lat_str = f"{lat:.6f}"
+    lng_str = f"{lng:.6f}"
+    filename = f"{lat_str}_{lng_str}_{heading}_{params['pitch']}_{params['fov']}.jpg"
+
+    filepath = IMAGES_DIR / filename
+
+    # Already collected on a previous run: skip the API call (and quota) entirely
+    if filename in existing_images or filepath.exists():
+        return filepath
+
     image_params = {
         "size": f"{params['size_x']}x{params['size_y']}",
         "location": f"{lat},{lng}",
@@ -126,43 +108,85 @@ def fetch_streetview(lat, lng, heading, api_counter, **params):
 
     while True:
         try:
-            api_counter.increment()
-            response = requests.get(STREETVIEW_BASE_URL, params=image_params)
-            response.raise_for_status()
-
-            if response.headers['content-type'].startswith('image/'):
-                lat_str = f"{lat:.6f}"
-                lng_str = f"{lng:.6f}"
-                filename = f"{lat_str}_{lng_str}_{heading}_{params['pitch']}_{params['fov']}.jpg"
-                
-                project_dir = pathlib.Path(PROJECT_NAME)
-                filepath = project_dir / "images" / filename
-                
-                if filepath.exists():
-                    return filepath
-
-                os.makedirs(filepath.parent, exist_ok=True)
-                
-                with open(filepath, "wb") as file:
-                    file.write(response.content)
-                
-                return filepath
-            else:
-                try:
-                    result = response.json()
-                    if 'error_message' in result:
-                        raise Exception(f"API Error: {result['error_message']}")
-                except requests.exceptions.JSONDecodeError:
-                    raise Exception("Unexpected response format from API")
-
-        except requests.exceptions.RequestException as e:
+            async with semaphore:
+                api_counter.increment()
+                async with session.get(STREETVIEW_BASE_URL, params=image_params) as response:
+                    response.raise_for_status()
+                    content_type = response.headers.get('content-type', '')
+
+                    if content_type.startswith('image/'):
+                        content = await response.read()
+                    else:
+                        try:
+                            result = await response.json(content_type=None)
+                        except ValueError:
+                            raise Exception("Unexpected response format from API")
+                        if 'error_message' in result:
+                            raise Exception(f"API Error: {result['error_message']}")
+                        raise Exception("Unexpected response format from API")
+
+            # IMAGES_DIR is created once in collect_streetview_data
+            with open(filepath, "wb") as file:
+                file.write(content)
+
+            return filepath
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             if current_delay > max_delay:
                 raise Exception(f"Failed after maximum retries: {str(e)}")
 
             print(f"Request failed. Waiting {current_delay} seconds before retrying.")
-            time.sleep(current_delay)
+            await asyncio.sleep(current_delay)
             current_delay *= 2
 
+async def download_streetview_images(sampling_points, writer, api_counter, existing_images):
+    """Download all Street View images concurrently and write metadata rows.
+
+    Tasks run concurrently under the semaphore; results are awaited in
+    submission order so the CSV writer stays strictly sequential.
+    """
+    connector = aiohttp.TCPConnector(limit=CONCURRENT_REQUESTS, keepalive_timeout=30)
+    timeout = aiohttp.ClientTimeout(total=30)
+    semaphore = asyncio.Semaphore(CONCURRENT_REQUESTS)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        jobs = [(lat, lng, heading)
+                for lat, lng in sampling_points
+                for heading in STREETVIEW_ANGLES]
+        tasks = [
+            asyncio.create_task(
+                fetch_streetview(session, semaphore, lat, lng, heading,
+                                 api_counter, existing_images, **STREETVIEW_PARAMS)
+            )
+            for lat, lng, heading in jobs
+        ]
+
+        pbar_images = tqdm(total=len(jobs), desc="Street View Images", position=1)
+        rows = []
+        for (lat, lng, heading), task in zip(jobs, tasks):
+            try:
+                filepath = await task
+
+                # Buffer metadata rows and flush them in batches
+                rows.append({
+                    'filename': filepath.name,
+                    'full_path': str(filepath),
+                    'latitude': lat,
+                    'longitude': lng,
+                    'heading': heading,
+                    'pitch': STREETVIEW_PARAMS['pitch'],
+                    'fov': STREETVIEW_PARAMS['fov']
+                })
+                if len(rows) >= CSV_BATCH_SIZE:
+                    writer.writerows(rows)
+                    rows.clear()
+
+            except Exception as e:
+                print(f"\nError capturing street view at ({lat}, {lng}, {heading}): {str(e)}")
+            pbar_images.update(1)
+        writer.writerows(rows)
+        pbar_images.close()
+
 def collect_streetview_data(start_location, end_location):
     """Collect Street View images along a route and save metadata to CSV."""
     print(f"\nInitializing Street View collection from {start_location} to {end_location}")
@@ -173,7 +197,8 @@ def collect_streetview_data(start_location, end_location):
     try:
         # Get directions
         print("Fetching route directions...")
-        directions_result = gmaps.directions(
+        directions_result = cached_directions(
+            gmaps,
             start_location,
             end_location,
             mode="driving",
@@ -185,11 +210,7 @@ def collect_streetview_data(start_location, end_location):
         
         # Calculate total distance
         route_points = decode_polyline(directions_result[0]['overview_polyline']['points'])
-        total_distance = sum(
-            haversine_distance(route_points[i][0], route_points[i][1], 
-                             route_points[i+1][0], route_points[i+1][1])
-            for i in range(len(route_points)-1)
-        )
+        total_distance = float(segment_distances(route_points).sum())
         
         print(f"\nRoute Details:")
         print(f"Total distance: {total_distance/1000:.2f} km")
@@ -208,42 +229,26 @@ def collect_streetview_data(start_location, end_location):
             raise Exception(f"Estimated API calls ({estimated_images}) exceeds maximum limit ({MAX_API_CALLS})")
         
         # Create project directory and CSV file
-        project_dir = pathlib.Path(PROJECT_NAME)
-        os.makedirs(project_dir / "images", exist_ok=True)
-        
-        csv_path = project_dir / "metadata.csv"
+        os.makedirs(IMAGES_DIR, exist_ok=True)
+
+        # Scan once so per-image "already downloaded" checks are a set lookup,
+        # not a stat() per call
+        with os.scandir(IMAGES_DIR) as entries:
+            existing_images = {entry.name for entry in entries if entry.is_file()}
+
+
+        csv_path = PROJECT_DIR / "metadata.csv"
         csv_fields = ['filename', 'full_path', 'latitude', 'longitude', 'heading', 'pitch', 'fov']
         
-        print(f"\nSaving data to {project_dir}")
+        print(f"\nSaving data to {PROJECT_DIR}")
         
-        with open(csv_path, 'w', newline='') as csvfile:
+        with open(csv_path, 'w', newline='', buffering=1 << 20) as csvfile:
             writer = csv.DictWriter(csvfile, fieldnames=csv_fields)
             writer.writeheader()
-            
-            # Progress bar for sampling points
-            pbar_points = tqdm(sampling_points, desc="Sampling Points", position=1)
-            
-            # Collect street view images for each point
-            for lat, lng in pbar_points:
-                for heading in STREETVIEW_ANGLES:
-                    try:
-                        filepath = fetch_streetview(lat, lng, heading, api_counter, **STREETVIEW_PARAMS)
-                        
-                        # Write metadata to CSV
-                        writer.writerow({
-                            'filename': filepath.name,
-                            'full_path': str(filepath),
-                            'latitude': lat,
-                            'longitude': lng,
-                            'heading': heading,
-                            'pitch': STREETVIEW_PARAMS['pitch'],
-                            'fov': STREETVIEW_PARAMS['fov']
-                        })
-                        
-                    except Exception as e:
-                        print(f"\nError capturing street view at ({lat}, {lng}, {heading}): {str(e)}")
-            
-            pbar_points.close()
+
+            # Collect street view images for each point, concurrently
+            asyncio.run(download_streetview_images(sampling_points, writer, api_counter,
+                                                   existing_images))
     
     finally:
         api_counter.close()
@@ -251,8 +256,8 @@ def collect_streetview_data(start_location, end_location):
     # Print summary
     print(f"\nCollection Summary:")
     print(f"Total API calls made: {api_counter.current_calls}")
-    print(f"Images collected: {sum(1 for _ in project_dir.glob('images/*.jpg'))}")
-    print(f"Output directory: {project_dir.absolute()}")
+    print(f"Images collected: {sum(1 for _ in PROJECT_DIR.glob('images/*.jpg'))}")
+    print(f"Output directory: {PROJECT_DIR.absolute()}")
     print(f"Metadata file: {csv_path.absolute()}")
 
 if __name__ == "__main__":
@@ -0,0 +1,145 @@
+"""File-backed cache for Google Maps API responses.
+
+The direction scripts are typically re-run many times while iterating on
+a project, and every run re-hits the paid Directions API with the same
+origin/destination pairs. cached_directions stores each response in a
+shelve database keyed by a hash of the canonicalized arguments, bucketed
+to the hour: traffic-aware results stay reasonably fresh while repeat
+runs within the same hour become free O(1) lookups.
+
+The place scripts get the same treatment via a SQLite database: place
+details are keyed by place_id and geocode responses by the query string,
+each with a TTL, so overlapping or repeated searches skip the detail
+calls they have already paid for.
+"""
+
+import hashlib
+import json
+import shelve
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+DIRECTIONS_CACHE = "gmaps_directions_cache"
+PLACES_CACHE_DB = "places_cache.db"
+PLACE_DETAILS_TTL = 7 * 24 * 3600  # seconds a cached place-details entry stays fresh
+GEOCODE_TTL = 30 * 24 * 3600  # geocoded locations barely move; keep them a month
+COMMIT_BATCH = 50  # writes buffered between sqlite commits
+
+# The place scripts fetch details from a thread pool; serialize access to
+# the shared connection
+_places_lock = threading.Lock()
+_pending_writes = 0
+
+
+def _cache_key(start, destination, bucket, **kwargs):
+    """Build a stable sha256 key from the canonicalized request arguments."""
+    canonical = json.dumps(
+        {
+            "start": str(start),
+            "destination": str(destination),
+            "bucket": bucket,
+            **{key: str(value) for key, value in kwargs.items()},
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def cached_directions(gmaps, start, destination, departure_time=None, **kwargs):
+    """Call gmaps.directions through the on-disk cache.
+
+    :param gmaps: An initialized googlemaps.Client.
+    :param start: Origin, as accepted by gmaps.directions.
+    :param destination: Destination, as accepted by gmaps.directions.
+    :param departure_time: Departure datetime; also defines the cache's
+        hour bucket (defaults to now).
+    :returns: The directions response (possibly from cache).
+    """
+    if departure_time is None:
+        departure_time = datetime.now()
+    bucket = departure_time.strftime('%Y%m%d%H')
+    key = _cache_key(start, destination, bucket, **kwargs)
+
+    with shelve.open(DIRECTIONS_CACHE) as cache:
+        if key in cache:
+            return cache[key]
+        result = gmaps.directions(start, destination,
+                                  departure_time=departure_time, **kwargs)
+        cache[key] = result
+        return result
+
+
+def open_places_cache(db_path=PLACES_CACHE_DB):
+    """Open (and create if needed) the SQLite place/geocode cache."""
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS place_details ("
+        "place_id TEXT PRIMARY KEY, json BLOB, fetched_at INT)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS geocode ("
+        "query TEXT PRIMARY KEY, json BLOB, fetched_at INT)"
+    )
+    return conn
+
+
+def _cache_get(conn, table, key_column, key, ttl):
+    with _places_lock:
+        row = conn.execute(
+            f"SELECT json, fetched_at FROM {table} WHERE {key_column} = ?", (key,)
+        ).fetchone()
+    if row is not None and time.time() - row[1] < ttl:
+        return json.loads(row[0])
+    return None
+
+
+def _cache_put(conn, table, key_column, key, value):
+    global _pending_writes
+    with _places_lock:
+        conn.execute(
+            f"INSERT OR REPLACE INTO {table} ({key_column}, json, fetched_at) "
+            "VALUES (?, ?, ?)",
+            (key, json.dumps(value, ensure_ascii=False), int(time.time()))
+        )
+        _pending_writes += 1
+        if _pending_writes >= COMMIT_BATCH:
+            conn.commit()
+            _pending_writes = 0
+
+
+def flush_places_cache(conn):
+    """Commit any writes still buffered since the last batch commit."""
+    global _pending_writes
+    with _places_lock:
+        conn.commit()
+        _pending_writes = 0
+
+
+def cached_place(conn, gmaps, place_id, ttl=PLACE_DETAILS_TTL, **kwargs):
+    """Call gmaps.place through the on-disk cache, keyed by place_id."""
+    key = place_id
+    if kwargs:
+        # Requests for different field sets must not shadow each other
+        canonical = json.dumps({k: str(v) for k, v in kwargs.items()}, sort_keys=True)
+        key = place_id + ":" + hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:16]
+    cached = _cache_get(conn, "place_details", "place_id", key, ttl)
+    if cached is not None:
+        return cached
+    result = gmaps.place(place_id, **kwargs)
+    _cache_put(conn, "place_details", "place_id", key, result)
+    return result
+
+
+def cached_geocode(conn, gmaps, query, ttl=GEOCODE_TTL):
+    """Call gmaps.geocode through the on-disk cache, keyed by the query."""
+    cached = _cache_get(conn, "geocode", "query", query, ttl)
+    if cached is not None:
+        return cached
+    result = gmaps.geocode(query)
+    _cache_put(conn, "geocode", "query", query, result)
+    return result
@@ -3,15 +3,29 @@ import os
 from dotenv import load_dotenv
 import csv
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from math import radians, cos, sin, asin, sqrt
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = prange = None
 from datetime import datetime
-import pandas as pd
+import numpy as np
 import signal
 import sys
 import logging
 import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 from googlemaps import exceptions as gmaps_exceptions
 
+from gmaps_cache import open_places_cache, cached_place, cached_geocode, flush_places_cache
+
 # Configuration
 load_dotenv()
 CENTER_POINT = "台南火車站"
@@ -21,12 +35,18 @@ GRID_DENSITY_KM = 0.1
 MAX_API_CALLS = 1000
 MAX_CALLS_PER_POINT = 3
 API_DELAY_SECONDS = 0.05
+DETAIL_WORKERS = 10  # concurrent place-details requests per result page
+POINT_WORKERS = 5  # grid points searched concurrently
+CSV_FLUSH_EVERY = 25  # rows written between explicit flushes
 
 OUTPUT_FILE = f"places_{SEARCH_KEYWORD}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+CSV_FIELDS = ['name', 'address', 'latitude', 'longitude', 'rating',
+              'total_ratings', 'phone', 'website', 'is_open']
 
 POINT_QUERY_RADIUS_KM = MAX_RADIUS_KM / (2 * GRID_DENSITY_KM)
 
 gmaps = googlemaps.Client(key=os.getenv('GOOGLE_MAPS_API_KEY'))
+places_cache = open_places_cache()
 
 # Set up logging
 log_filename = f"places_search_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
@@ -38,68 +58,155 @@ logging.basicConfig(
         logging.StreamHandler()
     ]
 )
+LOG = logging.getLogger(__name__)
 
 def haversine_distance(lat1, lon1, lat2, lon2):
-    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
-    dlon = lon2 - lon1 
-    dlat = lat2 - lat1 
+    # Inline degree-to-radian conversion; numba compiles this to a handful
+    # of float ops when available
+    deg = 0.017453292519943295
+    lon1, lat1, lon2, lat2 = lon1 * deg, lat1 * deg, lon2 * deg, lat2 * deg
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
     a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * asin(sqrt(a)) 
+    c = 2 * asin(sqrt(a))
     r = 6371
     return c * r
 
+if njit is not None:
+    haversine_distance = njit(cache=True, fastmath=True)(haversine_distance)
+
+# Candidate counts above this use the numba kernel (when available): one
+# fused pass with no intermediate arrays, parallelized across rows
+GRID_NUMBA_THRESHOLD = 250_000
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _grid_filter_numba(center_lat, center_lng, lat_degree, lng_degree,
+                           steps, max_radius_km):
+        side = 2 * steps + 1
+        out_lat = np.empty(side * side)
+        out_lng = np.empty(side * side)
+        keep = np.zeros(side * side, dtype=np.bool_)
+        deg = 0.017453292519943295
+        clat_r = center_lat * deg
+        clat_cos = cos(clat_r)
+        clng_r = center_lng * deg
+        for row in prange(side):
+            i = row - steps
+            for col in range(side):
+                j = col - steps
+                if i == 0 and j == 0:
+                    continue
+                new_lat = center_lat + i * lat_degree
+                new_lng = center_lng + j * lng_degree
+                lat_r = new_lat * deg
+                dlat = lat_r - clat_r
+                dlng = new_lng * deg - clng_r
+                a = sin(dlat/2)**2 + clat_cos * cos(lat_r) * sin(dlng/2)**2
+                if 2 * 6371 * asin(sqrt(a)) <= max_radius_km:
+                    index = row * side + col
+                    keep[index] = True
+                    out_lat[index] = new_lat
+                    out_lng[index] = new_lng
+        return out_lat, out_lng, keep
+
+
 def generate_grid_points(center_lat, center_lng, max_radius_km, density_km):
-    points = [(center_lat, center_lng)]
+    # The center point's trig terms are constant across the whole grid;
+    # convert them exactly once
+    clat_r = radians(center_lat)
+    clat_cos = cos(clat_r)
+    clng_r = radians(center_lng)
     
     lat_degree = density_km / 111
-    lng_degree = density_km / (111 * cos(radians(center_lat)))
+    lng_degree = density_km / (111 * clat_cos)
+    
+    steps = int(max_radius_km / density_km)
+    
+    if njit is not None and (2 * steps + 1) ** 2 >= GRID_NUMBA_THRESHOLD:
+        out_lat, out_lng, keep = _grid_filter_numba(
+            center_lat, center_lng, lat_degree, lng_degree, steps, max_radius_km)
+        return [(center_lat, center_lng)] + list(zip(out_lat[keep].tolist(),
+                                                     out_lng[keep].tolist()))
     
-    lat_steps = int(max_radius_km / density_km)
-    lng_steps = int(max_radius_km / density_km)
+    # Build every candidate in one shot and keep the in-range ones with a
+    # vectorized haversine instead of a Python double loop
+    i, j = np.meshgrid(np.arange(-steps, steps + 1), np.arange(-steps, steps + 1))
+    lat = center_lat + i * lat_degree
+    lng = center_lng + j * lng_degree
     
-    for i in range(-lat_steps, lat_steps + 1):
-        for j in range(-lng_steps, lng_steps + 1):
-            new_lat = center_lat + (i * lat_degree)
-            new_lng = center_lng + (j * lng_degree)
-            
-            if i == 0 and j == 0:
-                continue
-                
-            if haversine_distance(center_lat, center_lng, new_lat, new_lng) <= max_radius_km:
-                points.append((new_lat, new_lng))
+    # Cheap flat-earth prefilter: grid spacing is uniform in km, so the
+    # squared Euclidean distance settles almost every candidate without
+    # trig. Only the ~1% guard band around the radius (flat-vs-spherical
+    # distortion at this scale) needs the real haversine.
+    r2 = max_radius_km ** 2
+    d2 = (i.astype(np.float64)**2 + j.astype(np.float64)**2) * density_km**2
+    mask = d2 < r2 * 0.99
+    band = (d2 >= r2 * 0.99) & (d2 <= r2 * 1.01)
     
-    return points
-
-def save_results(found_places, interrupted=False):
-    """Save current results to CSV"""
-    if found_places:
-        # Create interrupted filename if keyboard interrupted
-        filename = OUTPUT_FILE
-        if interrupted:
-            base, ext = os.path.splitext(OUTPUT_FILE)
-            filename = f"{base}_interrupted{ext}"
-            
-        df = pd.DataFrame.from_dict(found_places, orient='index')
-        df.to_csv(filename, index=False, encoding='utf-8-sig')
-        print(f"\nSaved {len(found_places)} places to {filename}")
-    else:
+    lat_r = np.radians(lat[band])
+    dlat = lat_r - clat_r
+    dlng = np.radians(lng[band]) - clng_r
+    a = np.sin(dlat/2)**2 + clat_cos * np.cos(lat_r) * np.sin(dlng/2)**2
+    distance = 2 * 6371 * np.arcsin(np.sqrt(a))
+    
+    mask[band] = distance <= max_radius_km
+    mask &= ~((i == 0) & (j == 0))
+    
+    return [(center_lat, center_lng)] + list(zip(lat[mask].tolist(), lng[mask].tolist()))
+
+def dumps_debug(obj):
+    """Pretty-print an API response for debug logs, preferring orjson."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+    return json.dumps(obj, ensure_ascii=False, indent=2)
+
+def save_results(csvfile, row_count, interrupted=False):
+    """Flush and close the incrementally written CSV."""
+    csvfile.flush()
+    csvfile.close()
+    
+    if row_count == 0:
+        os.remove(OUTPUT_FILE)
         print("\nNo places to save")
+        return
+    
+    # Rename to an interrupted filename if keyboard interrupted
+    filename = OUTPUT_FILE
+    if interrupted:
+        base, ext = os.path.splitext(OUTPUT_FILE)
+        filename = f"{base}_interrupted{ext}"
+        os.replace(OUTPUT_FILE, filename)
+    print(f"\nSaved {row_count} places to {filename}")
 
 def search_places():
     api_calls = 0
-    found_places = {}
+    found_places = set()
+    seen_place_ids = set()
+    rows_since_flush = 0
+    state_lock = threading.Lock()
+    # Set on interrupt/error so in-flight points stop at their next
+    # checkpoint instead of scanning to completion
+    stop_event = threading.Event()
+
+    # Rows are streamed to disk as places are discovered, so memory stays
+    # flat and an interrupt loses at most CSV_FLUSH_EVERY rows
+    csvfile = open(OUTPUT_FILE, 'w', encoding='utf-8-sig', newline='')
+    writer = csv.DictWriter(csvfile, fieldnames=CSV_FIELDS)
+    writer.writeheader()
 
     try:
-        logging.info(f"Search initialized with parameters:")
-        logging.info(f"Center Point: {CENTER_POINT}")
-        logging.info(f"Maximum Radius: {MAX_RADIUS_KM}km")
-        logging.info(f"Grid Density: {GRID_DENSITY_KM}km")
-        logging.info(f"Point Query Radius: {POINT_QUERY_RADIUS_KM}km")
-        logging.info(f"Search Keyword: {SEARCH_KEYWORD}")
-
-        logging.info("Geocoding center point...")
-        geocode_result = gmaps.geocode(CENTER_POINT)
-        logging.debug(f"Geocode response: {json.dumps(geocode_result, ensure_ascii=False, indent=2)}")
+        LOG.info(f"Search initialized with parameters:")
+        LOG.info(f"Center Point: {CENTER_POINT}")
+        LOG.info(f"Maximum Radius: {MAX_RADIUS_KM}km")
+        LOG.info(f"Grid Density: {GRID_DENSITY_KM}km")
+        LOG.info(f"Point Query Radius: {POINT_QUERY_RADIUS_KM}km")
+        LOG.info(f"Search Keyword: {SEARCH_KEYWORD}")
+
+        LOG.info("Geocoding center point...")
+        geocode_result = cached_geocode(places_cache, gmaps, CENTER_POINT)
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug("Geocode response: %s", dumps_debug(geocode_result))
         
         if not geocode_result:
             raise Exception(f"Could not geocode center point: {CENTER_POINT}")
@@ -116,26 +223,35 @@ def search_places():
         )
         
         total_points = len(search_points)
-        logging.info(f"Generated {total_points} search points")
+        LOG.info(f"Generated {total_points} search points")
 
-        for point_index, (point_lat, point_lng) in enumerate(search_points, 1):
-            if api_calls >= MAX_API_CALLS:
-                logging.warning(f"Reached maximum total API calls limit ({MAX_API_CALLS})")
-                break
+        # Several points run at once so one point's forced pagination
+        # delay overlaps another point's work; shared counters, the seen-id
+        # set and the CSV writer are guarded by state_lock
+        def process_point(point_index, point_lat, point_lng):
+            nonlocal api_calls, rows_since_flush
+
+            if stop_event.is_set():
+                return
+            with state_lock:
+                if api_calls >= MAX_API_CALLS:
+                    return
+            LOG.debug(f"Searching point {point_index}/{total_points} at {point_lat:.4f}, {point_lng:.4f}")
 
-            logging.info(f"\nSearching point {point_index}/{total_points} at {point_lat:.4f}, {point_lng:.4f}")
-            
             point_api_calls = 0
+            point_new_places = 0
             token = None
-            
-            while True:
-                if api_calls >= MAX_API_CALLS or point_api_calls >= MAX_CALLS_PER_POINT:
+
+            while not stop_event.is_set():
+                with state_lock:
+                    budget_reached = api_calls >= MAX_API_CALLS
+                if budget_reached or point_api_calls >= MAX_CALLS_PER_POINT:
                     if point_api_calls >= MAX_CALLS_PER_POINT:
-                        logging.info(f"Reached maximum API calls for this point ({MAX_CALLS_PER_POINT})")
+                        LOG.debug(f"Reached maximum API calls for this point ({MAX_CALLS_PER_POINT})")
                     break
-                    
+
                 time.sleep(API_DELAY_SECONDS)
-                
+
                 request_params = {
                     "location": (point_lat, point_lng),
                     # "radius": int(POINT_QUERY_RADIUS_KM * 1000),
@@ -143,98 +259,141 @@ def search_places():
                     "rank_by": "distance",
                     # "page_token": token
                 }
-                logging.info(f"Making places_nearby request with params: {json.dumps(request_params, ensure_ascii=False)}")
-                
+                LOG.debug("Making places_nearby request with params: %s", request_params)
+
                 try:
                     places_result = gmaps.places_nearby(**request_params)
-                    api_calls += 1
+                    with state_lock:
+                        api_calls += 1
                     point_api_calls += 1
-                    
-                    logging.debug(f"places_nearby response: {json.dumps(places_result, ensure_ascii=False, indent=2)}")
-                    logging.info(f"Results count: {len(places_result.get('results', []))}")
+
+                    if LOG.isEnabledFor(logging.DEBUG):
+                        LOG.debug("places_nearby response: %s", dumps_debug(places_result))
+                    LOG.debug(f"Results count: {len(places_result.get('results', []))}")
 
                 except gmaps_exceptions.ApiError as e:
                     if "INVALID_REQUEST" in str(e):
-                        logging.warning(f"Invalid request for point {point_index}, skipping to next point. Error: {str(e)}")
+                        LOG.warning(f"Invalid request for point {point_index}, skipping to next point. Error: {str(e)}")
                         break  # Break the while loop to move to next point
                     else:
-                        logging.error(f"API Error: {str(e)}")
+                        LOG.error(f"API Error: {str(e)}")
                         raise  # Re-raise if it's not an INVALID_REQUEST error
 
+                # Reserve unseen place_ids under the lock so two points that
+                # share a result never fetch the same details twice
+                new_place_ids = []
+                nearby_details = {}
+                with state_lock:
+                    for place in places_result.get('results', []):
+                        place_id = place['place_id']
+                        if place_id in seen_place_ids:
+                            LOG.debug(f"Skipping duplicate place_id: {place_id}")
+                            continue
+                        seen_place_ids.add(place_id)
+                        new_place_ids.append(place_id)
+                        nearby_details[place_id] = place
+
+                # Fetch details for this page's new places concurrently;
+                # each request is an independent network round-trip
                 new_places = 0
-                for place in places_result.get('results', []):
-                    place_id = place['place_id']
-                    
-                    if place_id in found_places:
-                        logging.debug(f"Skipping duplicate place_id: {place_id}")
-                        continue
-                    
-                    if point_api_calls >= MAX_CALLS_PER_POINT:
-                        logging.info("Reached API call limit for this point, skipping remaining places")
-                        break
-                    
-                    time.sleep(API_DELAY_SECONDS)
-                    try:
-                        logging.debug(f"Requesting details for place_id: {place_id}")
-                        details = gmaps.place(place_id, fields=[
-                            'name', 'formatted_address', 'geometry', 'rating',
-                            'user_ratings_total', 'formatted_phone_number',
-                            'opening_hours', 'website'
-                        ])
-                        api_calls += 1
-                        # point_api_calls += 1
-                        
-                        logging.debug(f"Place details response: {json.dumps(details, ensure_ascii=False, indent=2)}")
-                        
-                        place_details = details['result']
-                        found_places[place_id] = {
-                            'name': place_details.get('name', ''),
-                            'address': place_details.get('formatted_address', ''),
-                            'latitude': place_details['geometry']['location']['lat'],
-                            'longitude': place_details['geometry']['location']['lng'],
-                            'rating': place_details.get('rating', ''),
-                            'total_ratings': place_details.get('user_ratings_total', ''),
-                            'phone': place_details.get('formatted_phone_number', ''),
-                            'website': place_details.get('website', ''),
-                            'is_open': place_details.get('opening_hours', {}).get('open_now', '')
-                        }
-                        new_places += 1
-                        logging.debug(f"Successfully added new place: {place_details.get('name', '')}")
-                        
-                    except gmaps_exceptions.ApiError as e:
-                        if "INVALID_REQUEST" in str(e):
-                            logging.warning(f"Invalid request for place details {place_id}, skipping. Error: {str(e)}")
-                            continue  # Skip to next place
-                        else:
-                            logging.error(f"API Error while getting place details: {str(e)}")
-                            raise
-
-                    except Exception as e:
-                        logging.error(f"Error getting details for place {place_id}: {str(e)}")
-                        continue
-
-                logging.info(f"Found {new_places} new places at this point")
-                logging.info(f"Total unique places so far: {len(found_places)}")
+                with ThreadPoolExecutor(max_workers=DETAIL_WORKERS) as executor:
+                    # places_nearby already returned name/geometry/rating/
+                    # open-now for each result, so the details call only has
+                    # to fetch the contact fields it can't provide
+                    futures = {
+                        executor.submit(cached_place, places_cache, gmaps, place_id, fields=[
+                            'formatted_address', 'formatted_phone_number', 'website'
+                        ]): place_id
+                        for place_id in new_place_ids
+                    }
+                    with state_lock:
+                        api_calls += len(futures)
+
+                    for future in as_completed(futures):
+                        place_id = futures[future]
+                        try:
+                            details = future.result()
+
+                            if LOG.isEnabledFor(logging.DEBUG):
+                                LOG.debug("Place details response: %s", dumps_debug(details))
+
+                            place_details = details['result']
+                            nearby = nearby_details[place_id]
+                            with state_lock:
+                                writer.writerow({
+                                    'name': nearby.get('name', ''),
+                                    'address': place_details.get('formatted_address', ''),
+                                    'latitude': nearby['geometry']['location']['lat'],
+                                    'longitude': nearby['geometry']['location']['lng'],
+                                    'rating': nearby.get('rating', ''),
+                                    'total_ratings': nearby.get('user_ratings_total', ''),
+                                    'phone': place_details.get('formatted_phone_number', ''),
+                                    'website': place_details.get('website', ''),
+                                    'is_open': nearby.get('opening_hours', {}).get('open_now', '')
+                                })
+                                found_places.add(place_id)
+                                rows_since_flush += 1
+                                if rows_since_flush >= CSV_FLUSH_EVERY:
+                                    csvfile.flush()
+                                    rows_since_flush = 0
+                            new_places += 1
+                            LOG.debug(f"Successfully added new place: {nearby.get('name', '')}")
+
+                        except gmaps_exceptions.ApiError as e:
+                            if "INVALID_REQUEST" in str(e):
+                                LOG.warning(f"Invalid request for place details {place_id}, skipping. Error: {str(e)}")
+                                continue  # Skip to next place
+                            else:
+                                LOG.error(f"API Error while getting place details: {str(e)}")
+                                raise
+
+                        except Exception as e:
+                            LOG.error(f"Error getting details for place {place_id}: {str(e)}")
+                            continue
+
+                point_new_places += new_places
 
                 token = places_result.get('next_page_token')
                 if not token or point_api_calls >= MAX_CALLS_PER_POINT:
-                    logging.info("No more pages available or reached point limit")
+                    LOG.debug("No more pages available or reached point limit")
                     break
 
-            logging.info(f"Completed point {point_index} with {point_api_calls} API calls")
+            LOG.info("Point %d/%d done: %d API calls, %d new places, %d unique so far",
+                     point_index, total_points, point_api_calls,
+                     point_new_places, len(found_places))
+
+        point_pool = ThreadPoolExecutor(max_workers=POINT_WORKERS)
+        try:
+            point_futures = [
+                point_pool.submit(process_point, point_index, point_lat, point_lng)
+                for point_index, (point_lat, point_lng) in enumerate(search_points, 1)
+            ]
+            for future in as_completed(point_futures):
+                future.result()
+        except BaseException:
+            # Drop queued points and stop running ones at their next
+            # checkpoint, then wait them out so no worker is still writing
+            # when the interrupt/error path below closes the CSV; a plain
+            # `with` block would instead scan every remaining point first
+            stop_event.set()
+            point_pool.shutdown(wait=True, cancel_futures=True)
+            raise
+        point_pool.shutdown()
 
-        save_results(found_places)
-        logging.info(f"Final API calls made: {api_calls}/{MAX_API_CALLS}")
+        save_results(csvfile, len(found_places))
+        LOG.info(f"Final API calls made: {api_calls}/{MAX_API_CALLS}")
 
     except KeyboardInterrupt:
-        logging.warning("\nKeyboard interrupt detected!")
-        save_results(found_places, interrupted=True)
-        logging.info(f"Process interrupted after {api_calls} API calls")
+        LOG.warning("\nKeyboard interrupt detected!")
+        save_results(csvfile, len(found_places), interrupted=True)
+        LOG.info(f"Process interrupted after {api_calls} API calls")
         sys.exit(0)
     except Exception as e:
-        logging.error(f"An error occurred: {str(e)}")
-        save_results(found_places, interrupted=True)
+        LOG.error(f"An error occurred: {str(e)}")
+        save_results(csvfile, len(found_places), interrupted=True)
         raise
+    finally:
+        flush_places_cache(places_cache)
 
 
 if __name__ == "__main__":
@@ -2,13 +2,29 @@ import googlemaps
 import os
 from dotenv import load_dotenv
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import make_dataclass, asdict
 from math import radians, cos, sin, asin, sqrt
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = prange = None
 from datetime import datetime
+import numpy as np
 import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 import logging
 import sys
 from googlemaps import exceptions as gmaps_exceptions
 
+from gmaps_cache import open_places_cache, cached_place, cached_geocode, flush_places_cache
+
 # Configuration
 load_dotenv()
 CENTER_POINT = "台南火車站"
@@ -18,6 +34,8 @@ GRID_DENSITY_KM = 0.3
 MAX_API_CALLS = 1000
 MAX_CALLS_PER_POINT = 3
 API_DELAY_SECONDS = 0.05
+DETAIL_WORKERS = 10  # concurrent place-details requests per result page
+POINT_WORKERS = 5  # grid points searched concurrently
 
 OUTPUT_FILE = f"places_{SEARCH_KEYWORD}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.geojson"
 
@@ -61,7 +79,18 @@ PLACE_FIELDS = [
     'wheelchair_accessible_entrance'
 ]
 
+# One shared slotted class instead of a ~30-key dict per place: the field
+# names are stored once on the class and each record is a flat attribute
+# block, which cuts per-place memory several-fold
+Place = make_dataclass(
+    'Place',
+    [(field, object, None) for field in PLACE_FIELDS if field != 'geometry']
+    + [('latitude', object, None), ('longitude', object, None)],
+    slots=True
+)
+
 gmaps = googlemaps.Client(key=os.getenv('GOOGLE_MAPS_API_KEY'))
+places_cache = open_places_cache()
 
 # Set up logging
 log_filename = f"places_search_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
@@ -73,93 +102,177 @@ logging.basicConfig(
         logging.StreamHandler()
     ]
 )
+LOG = logging.getLogger(__name__)
 
 def haversine_distance(lat1, lon1, lat2, lon2):
-    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
-    dlon = lon2 - lon1 
-    dlat = lat2 - lat1 
+    # Inline degree-to-radian conversion; numba compiles this to a handful
+    # of float ops when available
+    deg = 0.017453292519943295
+    lon1, lat1, lon2, lat2 = lon1 * deg, lat1 * deg, lon2 * deg, lat2 * deg
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
     a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * asin(sqrt(a)) 
+    c = 2 * asin(sqrt(a))
     r = 6371
     return c * r
 
+if njit is not None:
+    haversine_distance = njit(cache=True, fastmath=True)(haversine_distance)
+
+# Candidate counts above this use the numba kernel (when available): one
+# fused pass with no intermediate arrays, parallelized across rows
+GRID_NUMBA_THRESHOLD = 250_000
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _grid_filter_numba(center_lat, center_lng, lat_degree, lng_degree,
+                           steps, max_radius_km):
+        side = 2 * steps + 1
+        out_lat = np.empty(side * side)
+        out_lng = np.empty(side * side)
+        keep = np.zeros(side * side, dtype=np.bool_)
+        deg = 0.017453292519943295
+        clat_r = center_lat * deg
+        clat_cos = cos(clat_r)
+        clng_r = center_lng * deg
+        for row in prange(side):
+            i = row - steps
+            for col in range(side):
+                j = col - steps
+                if i == 0 and j == 0:
+                    continue
+                new_lat = center_lat + i * lat_degree
+                new_lng = center_lng + j * lng_degree
+                lat_r = new_lat * deg
+                dlat = lat_r - clat_r
+                dlng = new_lng * deg - clng_r
+                a = sin(dlat/2)**2 + clat_cos * cos(lat_r) * sin(dlng/2)**2
+                if 2 * 6371 * asin(sqrt(a)) <= max_radius_km:
+                    index = row * side + col
+                    keep[index] = True
+                    out_lat[index] = new_lat
+                    out_lng[index] = new_lng
+        return out_lat, out_lng, keep
+
+
 def generate_grid_points(center_lat, center_lng, max_radius_km, density_km):
-    points = [(center_lat, center_lng)]
+    # The center point's trig terms are constant across the whole grid;
+    # convert them exactly once
+    clat_r = radians(center_lat)
+    clat_cos = cos(clat_r)
+    clng_r = radians(center_lng)
     
     lat_degree = density_km / 111
-    lng_degree = density_km / (111 * cos(radians(center_lat)))
+    lng_degree = density_km / (111 * clat_cos)
     
-    lat_steps = int(max_radius_km / density_km)
-    lng_steps = int(max_radius_km / density_km)
+    steps = int(max_radius_km / density_km)
     
-    for i in range(-lat_steps, lat_steps + 1):
-        for j in range(-lng_steps, lng_steps + 1):
-            new_lat = center_lat + (i * lat_degree)
-            new_lng = center_lng + (j * lng_degree)
-            
-            if i == 0 and j == 0:
-                continue
-                
-            if haversine_distance(center_lat, center_lng, new_lat, new_lng) <= max_radius_km:
-                points.append((new_lat, new_lng))
+    if njit is not None and (2 * steps + 1) ** 2 >= GRID_NUMBA_THRESHOLD:
+        out_lat, out_lng, keep = _grid_filter_numba(
+            center_lat, center_lng, lat_degree, lng_degree, steps, max_radius_km)
+        return [(center_lat, center_lng)] + list(zip(out_lat[keep].tolist(),
+                                                     out_lng[keep].tolist()))
+    
+    # Build every candidate in one shot and keep the in-range ones with a
+    # vectorized haversine instead of a Python double loop
+    i, j = np.meshgrid(np.arange(-steps, steps + 1), np.arange(-steps, steps + 1))
+    lat = center_lat + i * lat_degree
+    lng = center_lng + j * lng_degree
+    
+    # Cheap flat-earth prefilter: grid spacing is uniform in km, so the
+    # squared Euclidean distance settles almost every candidate without
+    # trig. Only the ~1% guard band around the radius (flat-vs-spherical
+    # distortion at this scale) needs the real haversine.
+    r2 = max_radius_km ** 2
+    d2 = (i.astype(np.float64)**2 + j.astype(np.float64)**2) * density_km**2
+    mask = d2 < r2 * 0.99
+    band = (d2 >= r2 * 0.99) & (d2 <= r2 * 1.01)
     
-    return points
+    lat_r = np.radians(lat[band])
+    dlat = lat_r - clat_r
+    dlng = np.radians(lng[band]) - clng_r
+    a = np.sin(dlat/2)**2 + clat_cos * np.cos(lat_r) * np.sin(dlng/2)**2
+    distance = 2 * 6371 * np.arcsin(np.sqrt(a))
+    
+    mask[band] = distance <= max_radius_km
+    mask &= ~((i == 0) & (j == 0))
+    
+    return [(center_lat, center_lng)] + list(zip(lat[mask].tolist(), lng[mask].tolist()))
+
+# Pretty-printing doubles output size and serialization time; opt in
+# with e.g. PRETTY=1 when a human needs to read the file
+PRETTY_OUTPUT = bool(os.getenv('PRETTY'))
+
+def dumps_geojson(obj):
+    """Serialize one GeoJSON fragment to bytes, preferring orjson."""
+    if PRETTY_OUTPUT:
+        if orjson is not None:
+            return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode('utf-8')
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
 
 def save_results(found_places, interrupted=False):
-    """Save current results to GeoJSON"""
-    if found_places:
-        # Create interrupted filename if keyboard interrupted
-        filename = OUTPUT_FILE
-        if interrupted:
-            base, ext = os.path.splitext(OUTPUT_FILE)
-            filename = f"{base}_interrupted{ext}"
-        
-        # Convert to GeoJSON format
-        features = []
+    """Save current results to GeoJSON, streaming one feature at a time."""
+    if not found_places:
+        print("\nNo places to save")
+        return
+
+    # Create interrupted filename if keyboard interrupted
+    filename = OUTPUT_FILE
+    if interrupted:
+        base, ext = os.path.splitext(OUTPUT_FILE)
+        filename = f"{base}_interrupted{ext}"
+
+    # Write the FeatureCollection incrementally so the full features list
+    # is never materialized alongside found_places
+    written = 0
+    with open(filename, 'wb') as f:
+        f.write(b'{"type":"FeatureCollection","features":[')
         for place_id, place in found_places.items():
-            geometry = {
-                "type": "Point",
-                "coordinates": [place.get('longitude', 0), place.get('latitude', 0)]
-            }
-            
-            # Remove latitude and longitude from properties as they're in geometry
-            properties = place.copy()
-            properties.pop('latitude', None)
-            properties.pop('longitude', None)
-            
+            # Reserved entries whose details never arrived have no data yet
+            if place is None:
+                continue
+            properties = asdict(place)
+            # lat/lng live in the geometry; everything else is a property
+            lat = properties.pop('latitude')
+            lng = properties.pop('longitude')
             feature = {
                 "type": "Feature",
-                "geometry": geometry,
+                "geometry": {
+                    "type": "Point",
+                    "coordinates": [lng if lng is not None else 0,
+                                    lat if lat is not None else 0]
+                },
                 "properties": properties,
                 "id": place_id
             }
-            features.append(feature)
-        
-        geojson = {
-            "type": "FeatureCollection",
-            "features": features
-        }
-        
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(geojson, f, ensure_ascii=False, indent=2)
-        print(f"\nSaved {len(found_places)} places to {filename}")
-    else:
-        print("\nNo places to save")
+            if written:
+                f.write(b',')
+            f.write(dumps_geojson(feature))
+            written += 1
+        f.write(b']}')
+    print(f"\nSaved {written} places to {filename}")
 
 def search_places():
     api_calls = 0
     found_places = {}
+    state_lock = threading.Lock()
+    # Set on interrupt/error so in-flight points stop at their next
+    # checkpoint instead of scanning to completion
+    stop_event = threading.Event()
 
     try:
-        logging.info(f"Search initialized with parameters:")
-        logging.info(f"Center Point: {CENTER_POINT}")
-        logging.info(f"Maximum Radius: {MAX_RADIUS_KM}km")
-        logging.info(f"Grid Density: {GRID_DENSITY_KM}km")
-        logging.info(f"Point Query Radius: {POINT_QUERY_RADIUS_KM}km")
-        logging.info(f"Search Keyword: {SEARCH_KEYWORD}")
-
-        logging.info("Geocoding center point...")
-        geocode_result = gmaps.geocode(CENTER_POINT)
+        LOG.info(f"Search initialized with parameters:")
+        LOG.info(f"Center Point: {CENTER_POINT}")
+        LOG.info(f"Maximum Radius: {MAX_RADIUS_KM}km")
+        LOG.info(f"Grid Density: {GRID_DENSITY_KM}km")
+        LOG.info(f"Point Query Radius: {POINT_QUERY_RADIUS_KM}km")
+        LOG.info(f"Search Keyword: {SEARCH_KEYWORD}")
+
+        LOG.info("Geocoding center point...")
+        geocode_result = cached_geocode(places_cache, gmaps, CENTER_POINT)
         
         if not geocode_result:
             raise Exception(f"Could not geocode center point: {CENTER_POINT}")
@@ -176,119 +289,161 @@ def search_places():
         )
         
         total_points = len(search_points)
-        logging.info(f"Generated {total_points} search points")
+        LOG.info(f"Generated {total_points} search points")
 
-        for point_index, (point_lat, point_lng) in enumerate(search_points, 1):
-            if api_calls >= MAX_API_CALLS:
-                logging.warning(f"Reached maximum total API calls limit ({MAX_API_CALLS})")
-                break
+        # Several points run at once so one point's forced pagination
+        # delay overlaps another point's work; the shared call counter and
+        # found_places are guarded by state_lock
+        def process_point(point_index, point_lat, point_lng):
+            nonlocal api_calls
+
+            if stop_event.is_set():
+                return
+            with state_lock:
+                if api_calls >= MAX_API_CALLS:
+                    return
+            LOG.debug(f"Searching point {point_index}/{total_points} at {point_lat:.4f}, {point_lng:.4f}")
 
-            logging.info(f"\nSearching point {point_index}/{total_points} at {point_lat:.4f}, {point_lng:.4f}")
-            
             point_api_calls = 0
+            point_new_places = 0
             token = None
-            
-            while True:
-                if api_calls >= MAX_API_CALLS or point_api_calls >= MAX_CALLS_PER_POINT:
+
+            while not stop_event.is_set():
+                with state_lock:
+                    budget_reached = api_calls >= MAX_API_CALLS
+                if budget_reached or point_api_calls >= MAX_CALLS_PER_POINT:
                     if point_api_calls >= MAX_CALLS_PER_POINT:
-                        logging.info(f"Reached maximum API calls for this point ({MAX_CALLS_PER_POINT})")
+                        LOG.debug(f"Reached maximum API calls for this point ({MAX_CALLS_PER_POINT})")
                     break
-                    
+
                 time.sleep(API_DELAY_SECONDS)
-                
+
                 request_params = {
                     "location": (point_lat, point_lng),
                     "keyword": SEARCH_KEYWORD,
                     "rank_by": "distance"
                 }
-                
+
                 try:
                     places_result = gmaps.places_nearby(**request_params)
-                    api_calls += 1
+                    with state_lock:
+                        api_calls += 1
                     point_api_calls += 1
 
                 except gmaps_exceptions.ApiError as e:
                     if "INVALID_REQUEST" in str(e):
-                        logging.warning(f"Invalid request for point {point_index}, skipping to next point. Error: {str(e)}")
+                        LOG.warning(f"Invalid request for point {point_index}, skipping to next point. Error: {str(e)}")
                         break
                     else:
-                        logging.error(f"API Error: {str(e)}")
+                        LOG.error(f"API Error: {str(e)}")
                         raise
 
-                new_places = 0
-                for place in places_result.get('results', []):
-                    place_id = place['place_id']
-                    
-                    if place_id in found_places:
-                        logging.debug(f"Skipping duplicate place_id: {place_id}")
-                        continue
-                    
-                    if point_api_calls >= MAX_CALLS_PER_POINT:
-                        logging.info("Reached API call limit for this point, skipping remaining places")
-                        break
-                    
-                    time.sleep(API_DELAY_SECONDS)
-                    try:
-                        logging.debug(f"Requesting details for place_id: {place_id}")
-                        details = gmaps.place(place_id, fields=PLACE_FIELDS)
-                        api_calls += 1
-                        
-                        place_details = details['result']
-                        
-                        # Extract coordinates for GeoJSON
-                        lat = place_details['geometry']['location']['lat']
-                        lng = place_details['geometry']['location']['lng']
-                        
-                        # Store all available fields
-                        found_places[place_id] = {
-                            field: place_details.get(field) 
-                            for field in PLACE_FIELDS 
-                            if field != 'geometry'  # Handle geometry separately for GeoJSON
-                        }
-                        
-                        # Add coordinates for GeoJSON conversion
-                        found_places[place_id].update({
-                            'latitude': lat,
-                            'longitude': lng
-                        })
-                        
-                        new_places += 1
-                        logging.debug(f"Successfully added new place: {place_details.get('name', '')}")
-                        
-                    except gmaps_exceptions.ApiError as e:
-                        if "INVALID_REQUEST" in str(e):
-                            logging.warning(f"Invalid request for place details {place_id}, skipping. Error: {str(e)}")
+                # Reserve unseen place_ids under the lock so two points that
+                # share a result never fetch the same details twice
+                new_place_ids = []
+                with state_lock:
+                    for place in places_result.get('results', []):
+                        place_id = place['place_id']
+                        if place_id in found_places:
+                            LOG.debug(f"Skipping duplicate place_id: {place_id}")
                             continue
-                        else:
-                            logging.error(f"API Error while getting place details: {str(e)}")
-                            raise
+                        found_places[place_id] = None  # reserved; filled below
+                        new_place_ids.append(place_id)
+
+                # Fetch details for this page's new places concurrently;
+                # each request is an independent network round-trip
+                new_places = 0
+                with ThreadPoolExecutor(max_workers=DETAIL_WORKERS) as executor:
+                    futures = {
+                        executor.submit(cached_place, places_cache, gmaps, place_id, fields=PLACE_FIELDS): place_id
+                        for place_id in new_place_ids
+                    }
+                    with state_lock:
+                        api_calls += len(futures)
+
+                    for future in as_completed(futures):
+                        place_id = futures[future]
+                        try:
+                            details = future.result()
+                            place_details = details['result']
+
+                            # Extract coordinates for GeoJSON
+                            lat = place_details['geometry']['location']['lat']
+                            lng = place_details['geometry']['location']['lng']
+
+                            # Store all available fields; geometry is
+                            # handled separately for GeoJSON
+                            record = Place(
+                                **{field: place_details.get(field)
+                                   for field in PLACE_FIELDS if field != 'geometry'},
+                                latitude=lat,
+                                longitude=lng
+                            )
+                            with state_lock:
+                                found_places[place_id] = record
 
-                    except Exception as e:
-                        logging.error(f"Error getting details for place {place_id}: {str(e)}")
-                        continue
+                            new_places += 1
+                            LOG.debug(f"Successfully added new place: {place_details.get('name', '')}")
 
-                logging.info(f"Found {new_places} new places at this point")
-                logging.info(f"Total unique places so far: {len(found_places)}")
+                        except gmaps_exceptions.ApiError as e:
+                            if "INVALID_REQUEST" in str(e):
+                                LOG.warning(f"Invalid request for place details {place_id}, skipping. Error: {str(e)}")
+                                continue
+                            else:
+                                LOG.error(f"API Error while getting place details: {str(e)}")
+                                raise
+
+                        except Exception as e:
+                            LOG.error(f"Error getting details for place {place_id}: {str(e)}")
+                            continue
+
+                point_new_places += new_places
 
                 token = places_result.get('next_page_token')
                 if not token or point_api_calls >= MAX_CALLS_PER_POINT:
-                    logging.info("No more pages available or reached point limit")
+                    LOG.debug("No more pages available or reached point limit")
                     break
 
-            logging.info(f"Completed point {point_index} with {point_api_calls} API calls")
+            LOG.info("Point %d/%d done: %d API calls, %d new places, %d unique so far",
+                     point_index, total_points, point_api_calls,
+                     point_new_places, len(found_places))
+
+        point_pool = ThreadPoolExecutor(max_workers=POINT_WORKERS)
+        try:
+            point_futures = [
+                point_pool.submit(process_point, point_index, point_lat, point_lng)
+                for point_index, (point_lat, point_lng) in enumerate(search_points, 1)
+            ]
+            for future in as_completed(point_futures):
+                future.result()
+        except BaseException:
+            # Drop queued points and stop running ones at their next
+            # checkpoint, then wait them out so no worker still mutates
+            # found_places while the interrupt/error path saves it; a
+            # plain `with` block would instead scan every remaining point
+            stop_event.set()
+            point_pool.shutdown(wait=True, cancel_futures=True)
+            raise
+        point_pool.shutdown()
+
+        # Drop reservations whose detail fetch never completed
+        found_places = {pid: place for pid, place in found_places.items()
+                        if place is not None}
 
         save_results(found_places)
-        logging.info(f"Final API calls made: {api_calls}/{MAX_API_CALLS}")
+        LOG.info(f"Final API calls made: {api_calls}/{MAX_API_CALLS}")
 
     except KeyboardInterrupt:
-        logging.warning("\nKeyboard interrupt detected!")
+        LOG.warning("\nKeyboard interrupt detected!")
         save_results(found_places, interrupted=True)
-        logging.info(f"Process interrupted after {api_calls} API calls")
+        LOG.info(f"Process interrupted after {api_calls} API calls")
         sys.exit(0)
     except Exception as e:
-        logging.error(f"An error occurred: {str(e)}")
+        LOG.error(f"An error occurred: {str(e)}")
         save_results(found_places, interrupted=True)
         raise
+    finally:
+        flush_places_cache(places_cache)
 
 if __name__ == "__main__":
     search_places()
\ No newline at end of file
@@ -1,7 +1,10 @@
 import os
 import pathlib
+import shutil
 import requests
-import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
 from dotenv import load_dotenv
 
@@ -11,6 +14,23 @@ API_KEY = key=os.getenv('GOOGLE_MAPS_API_KEY')
 TIMEZONE_BASE_URL = "https://maps.googleapis.com/maps/api/timezone/json"
 STREETVIEW_BASE_URL = "https://maps.googleapis.com/maps/api/streetview"
 PWD = pathlib.Path(__file__).parent.absolute()
+MAX_WORKERS = 8  # concurrent street view downloads
+
+# Create the output directory once at import instead of stat'ing it on
+# every saved image
+STREETVIEW_DIR = PWD / "streetview"
+STREETVIEW_DIR.mkdir(parents=True, exist_ok=True)
+
+# One session for all requests so TLS connections are reused across calls.
+# Retries (with backoff, honoring Retry-After) happen inside urllib3
+# instead of a hand-rolled sleep/double loop per call.
+session = requests.Session()
+session.mount('https://', HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=20,
+    max_retries=Retry(total=5, backoff_factor=0.1,
+                      status_forcelist=[429, 500, 502, 503, 504])
+))
 
 
 def streetview(lat, lng, heading, pitch, fov=90, size_x=640, size_y=640):
@@ -32,6 +52,25 @@ def streetview(lat, lng, heading, pitch, fov=90, size_x=640, size_y=640):
     Raises:
         Exception: If the request fails after maximum retries or receives an error response
     """
+    # Generate unique filename using all parameters
+    # 0 padding the lat/lng to 6 decimal places
+    lat_str = f"{lat:.6f}"
+    lng_str = f"{lng:.6f}"
+    filename = f"{lat_str}_{lng_str}_{heading}_{pitch}_{fov}.jpg"
+    filepath = STREETVIEW_DIR / filename
+
+    # Already downloaded: skip the network round trip entirely
+    if filepath.exists():
+        return filepath
+
+    # The metadata endpoint is free; confirm imagery exists before paying
+    # for the image fetch
+    metadata = session.get(f"{STREETVIEW_BASE_URL}/metadata",
+                           params={"location": f"{lat},{lng}", "key": API_KEY}).json()
+    if metadata.get('status') != 'OK':
+        print(f"No street view imagery at {lat},{lng}: {metadata.get('status')}")
+        return None
+
     params = {
         "size": f"{size_x}x{size_y}",
         "location": f"{lat},{lng}",
@@ -42,55 +81,33 @@ def streetview(lat, lng, heading, pitch, fov=90, size_x=640, size_y=640):
         "return_error_code": "true"
     }
 
-    current_delay = 0.1  # Initial retry delay of 100ms
-    max_delay = 5  # Maximum retry delay of 5 seconds
-
-    while True:
-        try:
-            # Get the API response
-            response = requests.get(STREETVIEW_BASE_URL, params=params)
-            response.raise_for_status()
-            
-            # Check if we received an image (Street View API returns image directly)
-            if response.headers['content-type'].startswith('image/'):
-                # Generate unique filename using all parameters
-                # 0 padding the lat/lng to 6 decimal places
-                lat_str = f"{lat:.6f}"
-                lng_str = f"{lng:.6f}"
-                filename = f"{lat_str}_{lng_str}_{heading}_{pitch}_{fov}.jpg"
-                filepath = PWD / "streetview" / filename
-                # if filename is exist, skip this request
-                
-                if filepath.exists():
-                    return
+    # Stream the API response; the mounted adapter retries transient failures
+    with session.get(STREETVIEW_BASE_URL, params=params, stream=True) as response:
+        response.raise_for_status()
 
-                # Create the directory if it doesn't exist
-                os.makedirs(filepath.parent, exist_ok=True)
-                
-                # Save the image
-                with open(filepath, "wb") as file:
-                    file.write(response.content)
-                
-                return filepath
-            else:
-                # If we didn't get an image, there might be an error response in JSON
-                try:
-                    result = response.json()
-                    if 'error_message' in result:
-                        raise Exception(f"API Error: {result['error_message']}")
-                except requests.exceptions.JSONDecodeError:
-                    raise Exception("Unexpected response format from API")
+        # Check if we received an image (Street View API returns image
+        # directly); the content type is in the headers, before any body read
+        if not response.headers['content-type'].startswith('image/'):
+            # If we didn't get an image, there might be an error response in JSON
+            try:
+                result = response.json()
+            except requests.exceptions.JSONDecodeError:
+                raise Exception("Unexpected response format from API")
+            if 'error_message' in result:
+                raise Exception(f"API Error: {result['error_message']}")
+            raise Exception("Unexpected response format from API")
 
-        except requests.exceptions.RequestException as e:
-            if current_delay > max_delay:
-                raise Exception(f"Failed after maximum retries: {str(e)}")
+        # Copy the body straight to disk without buffering it in memory
+        with open(filepath, "wb") as file:
+            shutil.copyfileobj(response.raw, file)
 
-            print(f"Request failed. Waiting {current_delay} seconds before retrying.")
-            time.sleep(current_delay)
-            current_delay *= 2  # Increase the delay each time we retry
+    return filepath
 
     
 if __name__ == "__main__":
-    for i in range(0, 360, 30):
-        streetview(23.021248, 120.202918, i, 0, 240, 640, 640)
-    
\ No newline at end of file
+    # Each download is pure I/O, so fetch the headings in parallel
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        list(executor.map(
+            lambda heading: streetview(23.021248, 120.202918, heading, 0, 240, 640, 640),
+            range(0, 360, 30)
+        ))
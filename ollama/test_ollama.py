@@ -3,12 +3,31 @@ import base64
 import json
 import os
 import time
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 IMAGE_DIR = "./images"
 PROMPT = "summarize this image in one sentence"
 MODEL = "llava:7b"
 IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif'}
 
+# Reuse one connection across all requests instead of a TCP handshake per
+# image; transient failures (connection errors, 429/5xx) retry with
+# exponential backoff inside urllib3
+_SESSION = requests.Session()
+_SESSION.mount('http://', HTTPAdapter(
+    max_retries=Retry(total=4, backoff_factor=0.5,
+                      status_forcelist=[429, 500, 502, 503, 504])))
+
+# Generation is slow, so the read timeout is generous; the connect
+# timeout fails fast when the server is unreachable
+REQUEST_TIMEOUT = (5, 300)
+
 
 def analyze_image_with_ollama(image_path, model='llava:7b', prompt='Describe this image in detail'):
     """
@@ -34,23 +53,35 @@ def analyze_image_with_ollama(image_path, model='llava:7b', prompt='Describe thi
     url = 'http://127.0.0.1:11434/api/generate'
     
     try:
-        # Send POST request to Ollama server
-        response = requests.post(url, json=payload, stream=True)
+        # Send POST request to Ollama server; orjson serializes the large
+        # Base64 payload faster than the stdlib encoder when available
+        if orjson is not None:
+            response = _SESSION.post(url, data=orjson.dumps(payload),
+                                     headers={'Content-Type': 'application/json'},
+                                     stream=True, timeout=REQUEST_TIMEOUT)
+        else:
+            response = _SESSION.post(url, json=payload, stream=True, timeout=REQUEST_TIMEOUT)
         
         # Check if the request was successful
         response.raise_for_status()
         
-        # Process the streaming response
-        full_response = ""
-        for line in response.iter_lines():
+        # Process the streaming response; collect fragments and join once
+        # instead of rebuilding the string per chunk
+        parts = []
+        # Large chunks mean fewer Python-level iterations on long
+        # responses; lines stay bytes and go straight to the JSON parser
+        for line in response.iter_lines(chunk_size=65536, decode_unicode=False):
             if line:
                 try:
-                    # Parse each JSON line
-                    json_response = json.loads(line.decode('utf-8'))
+                    # Parse each JSON line (both parsers accept bytes)
+                    if orjson is not None:
+                        json_response = orjson.loads(line)
+                    else:
+                        json_response = json.loads(line)
                     
                     # Check if the response contains a text fragment
                     if 'response' in json_response:
-                        full_response += json_response['response']
+                        parts.append(json_response['response'])
                     
                     # Check if the stream is complete
                     if json_response.get('done', False):
@@ -59,7 +90,7 @@ def analyze_image_with_ollama(image_path, model='llava:7b', prompt='Describe thi
                 except json.JSONDecodeError:
                     print("Error decoding JSON response")
         
-        return full_response.strip()
+        return "".join(parts).strip()
     
     except requests.RequestException as e:
         print(f"Error communicating with Ollama server: {e}")
@@ -68,13 +99,20 @@ def analyze_image_with_ollama(image_path, model='llava:7b', prompt='Describe thi
 
 start_time = time.time()
 
-for image in os.listdir(IMAGE_DIR):
-    if os.path.splitext(image)[1].lower() in IMAGE_EXTENSIONS:
-        image_path = os.path.join(IMAGE_DIR, image)
-        analysis = analyze_image_with_ollama(image_path, MODEL, PROMPT)
-        if analysis:
-            print(f"{image}: {analysis}")
+# scandir yields name and type in one pass instead of a stat per entry,
+# and listing once means the average below counts the images actually
+# analyzed rather than every directory entry
+with os.scandir(IMAGE_DIR) as entries:
+    images = [entry.path for entry in entries
+              if entry.is_file()
+              and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS]
+
+for image_path in images:
+    analysis = analyze_image_with_ollama(image_path, MODEL, PROMPT)
+    if analysis:
+        print(f"{os.path.basename(image_path)}: {analysis}")
 
 end_time = time.time()
 print(f"Time taken: {end_time - start_time:.2f} seconds")
-print(f"average time taken: {(end_time - start_time)/len(os.listdir(IMAGE_DIR)):.2f} seconds")
\ No newline at end of file
+if images:
+    print(f"average time taken: {(end_time - start_time)/len(images):.2f} seconds")
\ No newline at end of file